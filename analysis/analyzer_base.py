@@ -1,7 +1,7 @@
-import cPickle as pickle
-
 import matplotlib.pyplot as plt
 
+import numpy as np
+
 
 class AnalyzerBase(object):
   """ Base class for analyzers. """
@@ -15,7 +15,7 @@ class AnalyzerBase(object):
   def _load_data(self, data_file):
     """ Loads the data from a file. """
     print "Loading validation data..."
-    self._data = pickle.load(file(data_file, "rb"))
+    self._data = np.load(data_file, allow_pickle=False)
 
   def _write_report(self, report):
     """ Writes a report to the command line. The report is a list, where each
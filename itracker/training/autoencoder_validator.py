@@ -1,4 +1,3 @@
-import cPickle as pickle
 import logging
 
 import numpy as np
@@ -41,68 +40,44 @@ class Validator(validator.Validator):
     self.__session_num = session_num
 
   def validate(self, num_batches):
+    # tqdm is only needed for validation, so don't make it a requirement for
+    # training too.
+    from tqdm import tqdm
+
     # Get the underlying TensorFlow session.
     session = K.tensorflow_backend.get_session()
 
-    # Create a coordinator and run queues.
-    coord = tf.train.Coordinator()
-    threads = tf.train.start_queue_runners(coord=coord, sess=session)
-
-    total_gaze_error = []
-    total_decode_error = []
-    total_encoding = []
-    total_pose = []
-    total_session_num = []
+    # Data matrix, with the variables as columns. This gets allocated once we
+    # know the batch size.
+    data_matrix = None
+    batch_size = None
 
-    percentage = 0.0
-    for i in range(0, num_batches):
-      # Run the session to extract the values we need. Make sure we put Keras in
-      # testing mode.
+    for i in tqdm(range(0, num_batches), desc="Validating"):
+      # Run the session to extract the values we need.
       gaze_error, decode_error, encoding, pose, session_num = \
           session.run([self.__gaze_error, self.__decode_error, self.__encoding,
-                       self.__pose, self.__session_num],
-                      feed_dict={K.learning_phase(): 0})
+                       self.__pose, self.__session_num])
 
-      total_gaze_error.extend(gaze_error)
       # Reduce across pixels so we have a single number for each image.
       decode_error = np.mean(decode_error, axis=(1, 2))
-      total_decode_error.extend(decode_error)
-      total_encoding.extend(encoding)
-      total_pose.extend(pose)
-      total_session_num.extend(session_num)
 
-      new_percentage = float(i) / num_batches * 100
-      if new_percentage - percentage > 0.01:
-        print "Validating. (%.2f%% complete)" % (new_percentage)
-        percentage = new_percentage
-
-    coord.request_stop()
-    coord.join(threads)
+      if data_matrix is None:
+        # Allocate space for all the batches up front. We have one column each
+        # for the errors and session number, three for the pose, and the rest
+        # for the encoding.
+        batch_size, encoding_size = encoding.shape
+        data_matrix = np.empty((num_batches * batch_size, 6 + encoding_size),
+                               dtype=np.float64)
+
+      # Copy the batch into the data matrix.
+      batch_rows = data_matrix[i * batch_size:(i + 1) * batch_size]
+      batch_rows[:, 0] = gaze_error
+      batch_rows[:, 1] = decode_error
+      batch_rows[:, 2:5] = pose
+      batch_rows[:, 5] = np.reshape(session_num, [-1])
+      batch_rows[:, 6:] = encoding
 
     print "Saving data matrix..."
 
-    # Create data matrix. First, we need to stack pose, since that contains
-    # three rows.
-    pose_stack = np.stack(total_pose, axis=1)
-    # Add error rows.
-    gaze_error_row = np.asarray(total_gaze_error)
-    gaze_error_row = np.expand_dims(gaze_error_row, 0)
-    decode_error_row = np.asarray(total_decode_error)
-    decode_error_row = np.expand_dims(decode_error_row, 0)
-    # Stack the encodings and add them.
-    encoding_stack = np.stack(total_encoding, axis=1)
-    # Add row for the session number.
-    session_num_row = np.asarray(total_session_num)
-    session_num_row = session_num_row.T
-
-    data_matrix = np.concatenate((gaze_error_row, decode_error_row,
-                                  pose_stack, session_num_row, encoding_stack),
-                                 axis=0)
-
-    # Make the variables columns.
-    data_matrix = data_matrix.T
-
     # Save it.
-    data_file = open(self._data_file, "wb")
-    pickle.dump(data_matrix, data_file)
-    data_file.close()
+    np.save(self._data_file, data_matrix, allow_pickle=False)
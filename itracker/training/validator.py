@@ -1,5 +1,3 @@
-import cPickle as pickle
-
 import logging
 
 import numpy as np
@@ -20,7 +18,7 @@ class Validator(object):
   """ Handles validation and statistical analysis of a model. """
 
   def __init__(self, data_tensors, labels, args,
-               out_file="validation_data.pkl"):
+               out_file="validation_data.npy"):
     """
     Args:
       data_tensors: The input tensors for the model.
@@ -41,6 +39,10 @@ class Validator(object):
   def _build_model(self):
     """ Builds the model and loads the model weights. It also modifies
     self.__labels according to the model. """
+    # We only ever run the model in testing mode, so fix the learning phase
+    # before building it. That way, it doesn't have to be fed for every batch.
+    K.set_learning_phase(0)
+
     autoenc_weights = None
     clusters = None
     if config.NET_ARCH == branched_autoenc_network.BranchedAutoencNetwork:
@@ -68,39 +70,40 @@ class Validator(object):
     logger.info("Loading pretrained model '%s'." % (self.__save_path))
     self._model.load_weights(self.__save_path)
 
-  def __compute_face_pos(self, masks):
-    """ Computes the position of the face, given the bitmask.
+  @staticmethod
+  def __compute_face_attributes(masks):
+    """ Computes the area and position of the face, given the bitmask.
     Args:
-      masks: The bitmasks to process.
+      masks: The bitmasks to process, as a numpy array.
     Returns:
-      Index of the top left corner of the face box. """
-    def face_pos(mask):
-      """ Determines face position in a single mask image.
-      Args:
-        mask: The mask image.
-      Returns:
-        Index of the top left corner of the face box. """
-      # For the x position, first reduce each column.
-      columns = tf.count_nonzero(mask, axis=[1])
-      # Find an arbitrary value in the block of 1s.
-      block_index = tf.argmax(columns, axis=0)
-      # Chop off everything after that.
-      chopped_cols = columns[:block_index]
-      # Count leading zeros.
-      length = tf.cast(tf.shape(chopped_cols)[0], tf.int64)
-      x_pos = length - tf.count_nonzero(chopped_cols)
-
-      # Do the same procedure for the y position.
-      rows = tf.count_nonzero(mask, axis=[0])
-      block_index = tf.argmax(rows, axis=0)
-      chopped_rows = rows[:block_index]
-      length = tf.cast(tf.shape(chopped_rows)[0], tf.int64)
-      y_pos = length - tf.count_nonzero(chopped_rows)
-
-      return tf.stack((x_pos, y_pos))
-
-    return tf.map_fn(face_pos, masks, back_prop=False,
-                     dtype=(tf.int64))
+      The number of pixels in each face box, and the row and column of the top
+      left corner of each face box. """
+    # Binarize the masks once. Then, reduce each row in a single pass to both a
+    # pixel count and an integer with one bit per pixel.
+    binary = (masks > 0).astype(np.int64)
+    width = masks.shape[2]
+    weights = np.stack((np.ones(width, dtype=np.int64),
+                        np.left_shift(1, np.arange(width, dtype=np.int64))),
+                       axis=1)
+    reduced = np.dot(binary, weights)
+    row_counts = reduced[:, :, 0]
+    row_bits = reduced[:, :, 1]
+
+    # The area is just the total number of pixels.
+    face_area = np.sum(row_counts, axis=1)
+
+    # The first nonzero row is the top edge of the face box. Argmax returns the
+    # first index in the case of ties, so we can use it to find this.
+    top = np.argmax(row_counts != 0, axis=1)
+
+    # For the left edge, OR all the rows together, and find the lowest set bit.
+    column_bits = np.bitwise_or.reduce(row_bits, axis=1)
+    lowest_bit = column_bits & -column_bits
+    # Empty masks have no set bits, in which case we use zero.
+    left = np.log2(np.maximum(lowest_bit, 1)).astype(np.int64)
+
+    # This (row, column) order is what the analyzer expects.
+    return (face_area, np.stack((top, left), axis=1))
 
   def _build_analysis_graph(self):
     """ Builds a portion of the graph for statistical analysis. """
@@ -117,79 +120,72 @@ class Validator(object):
     # Run the model.
     predicted_gaze = self._model([leye, reye, face, mask])
 
-    # Compute the error, both as the distance, and as the raw coordinate error.
-    self.__coord_error = self.__labels["dots"] - predicted_gaze
-    self.__error = metrics.distance_metric(self.__labels["dots"],
-                                           predicted_gaze)
-
     # Save the head pose so we can correlate this with the error.
     self.__pose = pose
     # Save the session num so we can analyze performance across subjects.
     self.__session_num = session_num
-    # Also save some attributes from the bitmask for this purpose.
-    self.__face_area = tf.count_nonzero(mask, axis=[1, 2])
-    self.__face_pos = self.__compute_face_pos(mask)
+    # Also save the bitmask, so we can extract some attributes from it for this
+    # purpose. This is cheap enough that it gets done on the CPU.
+    self.__mask = mask
+
+    # Compile the error computation with XLA, so that the elementwise
+    # subtract, square, sum, and sqrt chain gets fused into a single kernel.
+    jit_scope = tf.contrib.compiler.jit.experimental_jit_scope
+    with jit_scope():
+      # Compute the error, both as the distance, and as the raw coordinate
+      # error.
+      self.__coord_error = self.__labels["dots"] - predicted_gaze
+      self.__error = metrics.distance_metric(self.__labels["dots"],
+                                             predicted_gaze)
+
+    # Pack everything else into a single matrix, with the variables as columns,
+    # so we only have to fetch one tensor per batch.
+    columns = [tf.reshape(self.__error, [-1, 1]), self.__coord_error,
+               self.__pose, tf.reshape(self.__session_num, [-1, 1])]
+    columns = [tf.cast(column, tf.float32) for column in columns]
+    self.__batch_data = tf.concat(columns, axis=1)
 
   def validate(self, num_batches):
     """ Performs the actual validation.
     Args:
       num_batches: How many batches to run for the validation. """
+    # tqdm is only needed for validation, so don't make it a requirement for
+    # training too.
+    from tqdm import tqdm
+
     # Get the underlying TensorFlow session.
     session = K.tensorflow_backend.get_session()
 
-    total_error = []
-    total_coord_error = []
-    total_pose = []
-    total_face_area = []
-    total_face_pos = []
-    total_session_num = []
-
-    percentage = 0.0
-    for i in range(0, num_batches):
-      # Run the session to extract the values we need. Make sure we put Keras in
-      # testing mode.
-      error, coord_error, pose, face_area, face_pos, session_num = \
-          session.run([self.__error, self.__coord_error, self.__pose,
-                       self.__face_area, self.__face_pos, self.__session_num],
-                      feed_dict={K.learning_phase(): 0})
-
-      total_error.extend(error)
-      total_coord_error.extend(coord_error)
-      total_pose.extend(pose)
-      total_face_area.extend(face_area)
-      total_face_pos.extend(face_pos)
-      total_session_num.extend(session_num)
-
-      new_percentage = float(i) / num_batches * 100
-      if new_percentage - percentage > 0.01:
-        print "Validating. (%.2f%% complete)" % (new_percentage)
-        percentage = new_percentage
+    # Create a callable that extracts the values we need, so we don't have to
+    # re-process the fetches on every batch.
+    run_batch = session.make_callable([self.__batch_data, self.__mask])
+
+    # Data matrix, with the variables as columns. This gets allocated once we
+    # know the batch size.
+    data_matrix = None
+    batch_size = None
+
+    for i in tqdm(range(0, num_batches), desc="Validating"):
+      # Run the session to extract the values we need.
+      batch_data, masks = run_batch()
+
+      if data_matrix is None:
+        # Allocate space for all the batches up front. We need three extra
+        # columns for the face area and position.
+        batch_size, num_cols = batch_data.shape
+        data_matrix = np.empty((num_batches * batch_size, num_cols + 3),
+                               dtype=np.float64)
+
+      # Copy the batch into the data matrix. The face area and position go
+      # between the pose and the session number.
+      batch_rows = data_matrix[i * batch_size:(i + 1) * batch_size]
+      batch_rows[:, :6] = batch_data[:, :6]
+      face_area, face_pos = self.__compute_face_attributes(masks)
+      batch_rows[:, 6] = face_area
+      batch_rows[:, 7:9] = face_pos
+      batch_rows[:, 9] = batch_data[:, 6]
 
     print "Saving data matrix..."
 
-    # Create data matrix. First, we need to stack pose, since that contains
-    # three rows.
-    pose_stack = np.stack(total_pose, axis=1)
-    # Stack the error.
-    coord_error_stack = np.stack(total_coord_error, axis=1)
-    error_row = np.asarray(total_error)
-    error_row = np.expand_dims(error_row, 0)
-    # Add a row for the face area.
-    face_area_row = np.asarray(total_face_area)
-    face_area_row = np.expand_dims(face_area_row, 0)
-    # Stack the face position.
-    face_pos_stack = np.stack(total_face_pos, axis=1)
-    # Add a row for the session number.
-    session_num_row = np.asarray(total_session_num)
-    session_num_row = session_num_row.T
-    data_matrix = np.concatenate((error_row, coord_error_stack, pose_stack,
-                                  face_area_row, face_pos_stack,
-                                  session_num_row), axis=0)
-
-    # Make the variables columns.
-    data_matrix = data_matrix.T
-
     # Save it.
-    data_file = open(self._data_file, "wb")
-    pickle.dump(data_matrix, data_file)
-    data_file.close()
+    np.save(self._data_file, data_matrix, allow_pickle=False)